@@ -1,6 +1,15 @@
 import onnxruntime_genai as og
 import os
 import sys
+from model_utils import PromptTemplate, load_llm, pin_to_numa_node
+
+MAX_LENGTH = 2048
+
+def create_generator(model):
+    """Creates a generator whose KV cache is kept across turns of the conversation."""
+    params = og.GeneratorParams(model)
+    params.set_search_options(max_length=MAX_LENGTH)
+    return og.Generator(model, params)
 
 def main():
     model_path = "./model"
@@ -9,10 +18,13 @@ def main():
         sys.exit(1)
 
     print("Loading model... (this may take a few seconds)")
+    # Cross-socket weight reads are slower than local ones, and decoding streams every weight per token
+    pin_to_numa_node()
     try:
-        model = og.Model(model_path)
+        model = load_llm(model_path)
         tokenizer = og.Tokenizer(model)
         tokenizer_stream = tokenizer.create_stream()
+        template = PromptTemplate(tokenizer)
     except Exception as e:
         print(f"Failed to load model: {e}")
         sys.exit(1)
@@ -20,6 +32,9 @@ def main():
     print("Model loaded. Type 'exit' to quit.")
     print("-" * 50)
 
+    generator = None
+    token_count = 0
+
     while True:
         try:
             text = input("User: ")
@@ -29,27 +44,29 @@ def main():
             print("\nExiting...")
             break
 
-        # Phi-3 prompt structure
-        prompt = f"<|user|>\n{text}<|end|>\n<|assistant|>\n"
-
-        input_tokens = tokenizer.encode(prompt)
+        # Phi-3 prompt structure. Only the new turn is encoded; earlier turns are already in the KV cache.
+        input_tokens = template.encode_turn(text)
 
-        params = og.GeneratorParams(model)
-        params.set_search_options(max_length=2048)
+        # Start a fresh conversation once the context window would overflow
+        if generator is None or token_count + len(input_tokens) >= MAX_LENGTH:
+            generator = create_generator(model)
+            token_count = 0
 
-        generator = og.Generator(model, params)
         generator.append_tokens(input_tokens)
+        token_count += len(input_tokens)
 
         print("Assistant: ", end="", flush=True)
 
         try:
             while not generator.is_done():
                 generator.generate_next_token()
+                token_count += 1
 
                 new_token = generator.get_next_tokens()[0]
                 print(tokenizer_stream.decode(new_token), end="", flush=True)
         except Exception as e:
             print(f"\nError during generation: {e}")
+            generator = None
         
         print("\n")
 
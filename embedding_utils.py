@@ -1,65 +1,199 @@
 import os
+import functools
+import glob
+import hashlib
 import pickle
+import re
+import tempfile
 import numpy as np
 import faiss
+import torch
 from sentence_transformers import SentenceTransformer
-import pypdf
+from sentence_transformers.quantization import quantize_embeddings
 import docx
 import io
-from typing import List, Dict, Tuple
+from typing import List, Dict, Set, Tuple
+from pdf_utils import extract_pdf_text
+
+def cpu_flags() -> Set[str]:
+    """Returns the CPU feature flags reported by /proc/cpuinfo (empty if unavailable)."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    return set(line.split(':', 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+# A sentence runs up to its closing punctuation, ASCII or CJK (。！？), or the end of the text.
+# Scanning the UTF-8 bytes is cheaper than scanning str; the multi-byte terminators are matched
+# as whole characters, so every sentence boundary falls on a character boundary.
+_SENTENCE_RE = re.compile(rb'(?:[^.!?\xe3\xef]+|\xe3(?!\x80\x82)|\xef(?!\xbc[\x81\x9f]))*'
+                          rb'(?:(?:[.!?]|\xe3\x80\x82|\xef\xbc[\x81\x9f])+|\Z)')
+# Bump when chunking or the saved index layout changes, so stale cached indexes are rebuilt
+CACHE_VERSION = 3
+
+# Chunks are ~500 characters, which fits comfortably in 256 word pieces
+MAX_SEQ_LENGTH = 256
+ENCODE_BATCH_SIZE = 128
+
+# Corpora above this size switch from HNSW to a compressed IVF-PQ index
+IVF_PQ_THRESHOLD = 100_000
+# Up to this many int8 vectors, a flat scan is cheap enough that an HNSW graph isn't worth building
+SQ8_FLAT_THRESHOLD = 20_000
+# CAGRA needs more vectors than its intermediate graph degree; below this a GPU flat scan is faster anyway
+CAGRA_MIN_VECTORS = 10_000
+# Binary search shortlists this many candidates, which are then rescored with the float query
+BINARY_RESCORE_POOL = 50
+# Documents with this few chunks are returned whole; they'd nearly fill k results anyway
+SMALL_INDEX_SIZE = 8
+# Chunks sampled to estimate how similar unrelated parts of a document are
+SCORE_SAMPLE_SIZE = 256
+QUERY_CACHE_SIZE = 256
+QUERY_BATCH_SIZE = 32
+
+def _as_float32(embeddings: np.ndarray) -> np.ndarray:
+    """Returns embeddings as a contiguous float32 array, copying only if they aren't one already."""
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _encode_query(model, query_text: str) -> np.ndarray:
+    """Encodes a single query. Cached per (model, text), so the returned array is read-only."""
+    query_vector = _as_float32(model.encode([query_text], convert_to_numpy=True, normalize_embeddings=True,
+                                            precision='float32'))
+    query_vector.setflags(write=False)
+    return query_vector
+
+def _byte_windows(data: bytes, size: int) -> List[bytes]:
+    """Cuts UTF-8 data into windows of at most size bytes overlapping by ~10%, never splitting a character."""
+    def boundary(i):
+        # UTF-8 continuation bytes look like 0b10xxxxxx; back up to the start of their character
+        while 0 < i < len(data) and data[i] & 0xC0 == 0x80:
+            i -= 1
+        return i
+
+    windows = []
+    start = 0
+    while start < len(data):
+        end = boundary(min(start + size, len(data)))
+        if end <= start: # size is smaller than one character; take the whole character
+            end = start + 1
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                end += 1
+        windows.append(data[start:end])
+        if end == len(data):
+            break
+        next_start = boundary(start + size - size // 10)
+        start = next_start if next_start > start else end
+    return windows
 
 class RAGHandler:
-    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', index_path: str = './rag_index'):
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', index_path: str = './rag_index',
+                 onnx_model_path: str = './embed_model', precision: str = 'int8'):
+        if precision not in ('float32', 'int8', 'binary'):
+            raise ValueError(f"Unsupported precision: {precision}")
         self.model_name = model_name
+        self.precision = precision # Storage precision of indexed vectors on the CPU: float32, int8 or binary
         self.index_path = index_path
+        self.onnx_model_path = onnx_model_path
         self.model = None
         self.index = None
         self.chunks = [] # List to store text chunks corresponding to index vectors
+        self.min_score = None # Hits after the best one are dropped below this; set per document in create_index
+        self.gpu_resources = None # faiss.StandardGpuResources, created on first GPU build
+
+    def _quantized_onnx_file(self):
+        """Returns the INT8 ONNX export written by setup_embeddings.py, relative to onnx_model_path."""
+        matches = sorted(glob.glob(os.path.join(self.onnx_model_path, 'onnx', 'model_qint8_*.onnx')))
+        if not matches:
+            return None
+        return os.path.relpath(matches[0], self.onnx_model_path)
 
     def load_model(self):
-        """Loads the SentenceTransformer model."""
+        """Loads the SentenceTransformer model, preferring the quantized ONNX export if present."""
         if self.model is None:
-            print(f"Loading embedding model: {self.model_name}...")
-            self.model = SentenceTransformer(self.model_name)
+            onnx_file = self._quantized_onnx_file()
+            if torch.cuda.is_available():
+                # The INT8 export targets CPU kernels; on CUDA half precision is the faster path
+                print(f"Loading embedding model on CUDA (float16): {self.model_name}...")
+                self.model = SentenceTransformer(self.model_name, device='cuda',
+                                                 model_kwargs={'torch_dtype': torch.float16})
+            elif onnx_file:
+                print(f"Loading quantized ONNX embedding model: {onnx_file}...")
+                self.model = SentenceTransformer(self.onnx_model_path, backend='onnx',
+                                                 model_kwargs={'file_name': onnx_file})
+            else:
+                # Fall back to the PyTorch weights if setup_embeddings.py hasn't exported ONNX yet
+                model_kwargs = {}
+                if cpu_flags() & {'avx512_bf16', 'amx_bf16'}:
+                    model_kwargs['torch_dtype'] = torch.bfloat16
+                print(f"Loading embedding model: {self.model_name}...")
+                self.model = SentenceTransformer(self.model_name, model_kwargs=model_kwargs)
+            self.model.max_seq_length = MAX_SEQ_LENGTH
             print("Embedding model loaded.")
 
-    def _chunk_text(self, text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
-        """Splits text into chunks with overlap."""
+    def _chunk_text(self, text: str, chunk_size: int = 500, overlap_sentences: int = 1) -> List[str]:
+        """
+        Packs whole sentences into chunks of up to chunk_size bytes, repeating the last
+        overlap_sentences of each chunk at the start of the next for continuity.
+        """
         chunks = []
-        start = 0
-        text_len = len(text)
-
-        while start < text_len:
-            end = start + chunk_size
-            chunk = text[start:end]
-            chunks.append(chunk)
-            start += chunk_size - overlap
-        
-        return chunks
+        current = [] # Sentences (UTF-8 bytes) of the chunk being built
+        size = 0
+        fresh = False # Whether current holds sentences not yet emitted in a chunk
+
+        for match in _SENTENCE_RE.finditer(text.encode('utf-8')):
+            sentence = match.group()
+            if not sentence.strip():
+                continue
+            if current and size + len(sentence) > chunk_size:
+                if fresh:
+                    chunks.append(b''.join(current).decode('utf-8'))
+                current = current[-overlap_sentences:] if overlap_sentences else []
+                size = sum(len(s) for s in current)
+                fresh = False
+                # Only carry over as much of the overlap as still leaves room for this sentence
+                while current and size + len(sentence) > chunk_size:
+                    size -= len(current.pop(0))
+            if len(sentence) > chunk_size:
+                # A sentence longer than a chunk is cut into fixed-size windows overlapping by 10%
+                chunks.extend(window.decode('utf-8') for window in _byte_windows(sentence, chunk_size))
+                current, size, fresh = [], 0, False
+                continue
+            current.append(sentence)
+            size += len(sentence)
+            fresh = True
+
+        if fresh:
+            chunks.append(b''.join(current).decode('utf-8'))
+        chunks = (chunk.strip() for chunk in chunks)
+        return [chunk for chunk in chunks if chunk]
 
     def create_index(self, content, filename: str):
         """
         Chunks the provided content (text or bytes), computes embeddings, and builds the FAISS index in-memory.
+        The index is also saved under index_path, keyed by a hash of the content, and reused on re-upload.
         """
+        if isinstance(content, str) and filename.lower().endswith(('.pdf', '.docx')):
+            # If path is passed (legacy support or if needed)
+            with open(content, 'rb') as f:
+                content = f.read()
+
+        # Re-uploading the same document reuses the index saved last time and skips embedding entirely
+        key = self._cache_key(content, filename)
+        if self.load_index(key):
+            print(f"Loaded cached index with {self.index.ntotal} vectors.")
+            return
+
         self.load_model()
         
         text = ""
         if filename.lower().endswith('.pdf'):
-            if isinstance(content, str):
-                 # If path is passed (legacy support or if needed)
-                 reader = pypdf.PdfReader(content)
-            else:
-                 # BytesIO
-                 reader = pypdf.PdfReader(io.BytesIO(content))
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
+            text = extract_pdf_text(content)
         elif filename.lower().endswith('.docx'):
-            if isinstance(content, str):
-                doc = docx.Document(content)
-            else:
-                doc = docx.Document(io.BytesIO(content))
-            for para in doc.paragraphs:
-                text += para.text + "\n"
+            doc = docx.Document(io.BytesIO(content))
+            text = "".join(para.text + "\n" for para in doc.paragraphs)
         else:
             # Assume text
             if isinstance(content, bytes):
@@ -75,35 +209,233 @@ class RAGHandler:
             return
 
         print(f"Generated {len(self.chunks)} chunks. Computing embeddings...")
-        embeddings = self.model.encode(self.chunks)
-        
-        # Initialize FAISS index
-        dimension = embeddings.shape[1]
-        self.index = faiss.IndexFlatL2(dimension)
-        self.index.add(embeddings.astype('float32'))
+        # MiniLM is trained for cosine similarity, so normalize and search by inner product
+        embeddings = _as_float32(self.model.encode(self.chunks, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True,
+                                                   normalize_embeddings=True, show_progress_bar=False,
+                                                   precision='float32'))
+        self.index = self._build_index(embeddings)
+        self.min_score = self._score_threshold(embeddings)
         
         print(f"Index built with {self.index.ntotal} vectors.")
+        self.save_index(key)
+
+    def _cache_key(self, content, filename: str) -> str:
+        """Hashes the document together with everything else that determines its index."""
+        data = content.encode('utf-8') if isinstance(content, str) else content
+        device = 'gpu' if faiss.get_num_gpus() > 0 else 'cpu'
+        h = hashlib.blake2b(data, digest_size=16)
+        h.update(f"|{os.path.splitext(filename)[1].lower()}|{self.model_name}|{device}|{self.precision}|{CACHE_VERSION}".encode('utf-8'))
+        return h.hexdigest()
+
+    def _cache_paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.index_path, key)
+        return base + '.faiss', base + '.pkl'
+
+    def _write_atomic(self, path: str, write):
+        """Calls write(tmp_path) on a temporary file in index_path, then renames it onto path."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_path, suffix='.tmp')
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def save_index(self, key: str):
+        """Writes the current index and its chunks to index_path. Failures only skip caching."""
+        index_file, chunks_file = self._cache_paths(key)
+        index = self.index
+        binary = isinstance(index, faiss.IndexBinary)
+        saved = {'chunks': self.chunks, 'binary': binary, 'min_score': self.min_score}
+
+        def write_chunks(path):
+            with open(path, 'wb') as f:
+                pickle.dump(saved, f)
+
+        try:
+            os.makedirs(self.index_path, exist_ok=True)
+            if binary:
+                self._write_atomic(index_file, lambda path: faiss.write_index_binary(index, path))
+            else:
+                if self.gpu_resources is not None:
+                    index = faiss.index_gpu_to_cpu(index)
+                self._write_atomic(index_file, lambda path: faiss.write_index(index, path))
+            # The chunks file is written last; load_index only trusts a cache entry once it exists
+            self._write_atomic(chunks_file, write_chunks)
+        except Exception as e:
+            print(f"Warning: could not save index cache to {self.index_path}: {e}")
+
+    def load_index(self, key: str) -> bool:
+        """Loads a previously saved index and its chunks. Returns False if none is cached or it can't be read."""
+        index_file, chunks_file = self._cache_paths(key)
+        if not (os.path.exists(index_file) and os.path.exists(chunks_file)):
+            return False
+        try:
+            with open(chunks_file, 'rb') as f:
+                saved = pickle.load(f)
+            if saved['binary']:
+                index = faiss.read_index_binary(index_file)
+            else:
+                index = faiss.read_index(index_file)
+                if faiss.get_num_gpus() > 0:
+                    if self.gpu_resources is None:
+                        self.gpu_resources = faiss.StandardGpuResources()
+                    index = faiss.index_cpu_to_gpu(self.gpu_resources, 0, index)
+        except Exception as e:
+            print(f"Warning: ignoring unreadable index cache {chunks_file}, rebuilding: {e}")
+            return False
+        self.chunks = saved['chunks']
+        self.min_score = saved.get('min_score')
+        self.index = index
+        return True
+
+    def _build_index(self, embeddings: np.ndarray):
+        """Builds the search index on the GPU when FAISS has one available, otherwise on the CPU."""
+        if faiss.get_num_gpus() > 0:
+            return self._build_gpu_index(embeddings)
+        return self._build_cpu_index(embeddings)
+
+    def _build_gpu_index(self, embeddings: np.ndarray):
+        """Builds a GPU index: CAGRA when FAISS was built with cuVS, otherwise flat or IVF-PQ."""
+        dimension = embeddings.shape[1]
+        if self.gpu_resources is None:
+            self.gpu_resources = faiss.StandardGpuResources()
+
+        if hasattr(faiss, 'GpuIndexCagra') and len(embeddings) >= CAGRA_MIN_VECTORS:
+            print("Building CAGRA index on GPU (cuVS)...")
+            index = faiss.GpuIndexCagra(self.gpu_resources, dimension, faiss.METRIC_INNER_PRODUCT,
+                                        faiss.GpuIndexCagraConfig())
+            # CAGRA builds its graph from the training set, which is the full corpus
+            index.train(embeddings)
+            return index
+
+        if len(embeddings) > IVF_PQ_THRESHOLD:
+            cpu_index = faiss.index_factory(dimension, 'IVF1024,PQ32', faiss.METRIC_INNER_PRODUCT)
+            cpu_index.train(embeddings)
+            cpu_index.nprobe = 16
+        else:
+            cpu_index = faiss.IndexFlatIP(dimension)
+        index = faiss.index_cpu_to_gpu(self.gpu_resources, 0, cpu_index)
+        index.add(embeddings)
+        return index
+
+    def _build_cpu_index(self, embeddings: np.ndarray):
+        """Builds an approximate nearest-neighbour index over normalized embeddings."""
+        dimension = embeddings.shape[1]
+        if len(embeddings) > IVF_PQ_THRESHOLD:
+            # PQ codes are already far smaller than int8 or binary vectors
+            index = faiss.index_factory(dimension, 'IVF1024,PQ32', faiss.METRIC_INNER_PRODUCT)
+            index.train(embeddings)
+            index.nprobe = 16
+        elif self.precision == 'binary':
+            # One bit per dimension (32x smaller), searched by Hamming distance
+            index = faiss.IndexBinaryFlat(dimension)
+            index.add(quantize_embeddings(embeddings, precision='ubinary'))
+            return index
+        elif self.precision == 'int8':
+            # One byte per dimension (4x smaller); training learns each dimension's value range
+            if len(embeddings) <= SQ8_FLAT_THRESHOLD:
+                # Exact inner-product scan over the codes, using FAISS's SIMD int8 distance kernels
+                index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit,
+                                                   faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_8bit, 32,
+                                          faiss.METRIC_INNER_PRODUCT)
+                index.hnsw.efConstruction = 80
+            index.train(embeddings)
+        else:
+            index = faiss.IndexHNSWFlat(dimension, 32, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = 80
+        index.add(embeddings)
+        return index
+
+    def _score_threshold(self, embeddings: np.ndarray) -> float:
+        """
+        Returns the mean similarity between random pairs of chunks. A hit that matches the query
+        no better than unrelated chunks of the same document match each other is unlikely to help.
+        """
+        rng = np.random.default_rng(0)
+        sample = embeddings[rng.choice(len(embeddings), min(len(embeddings), SCORE_SAMPLE_SIZE), replace=False)]
+        if len(sample) < 2:
+            return float('-inf')
+        others = sample
+        if isinstance(self.index, faiss.IndexBinary):
+            # Score on the same scale _search_binary rescores with
+            others = np.where(sample > 0, 1.0, -1.0).astype('float32') / np.sqrt(sample.shape[1])
+        scores = (sample @ others.T)[~np.eye(len(sample), dtype=bool)]
+        # Short queries score lower against their answer than chunks do against each other,
+        # so a mean + std cutoff would also drop relevant hits
+        return float(scores.mean())
+
+    def _search_binary(self, query_vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Shortlists candidates by Hamming distance, then rescores them against the float query."""
+        pool = min(max(k, BINARY_RESCORE_POOL), self.index.ntotal)
+        _, candidates = self.index.search(quantize_embeddings(query_vector, precision='ubinary'), pool)
+        candidates = candidates[0][candidates[0] != -1]
+
+        codes = np.vstack([self.index.reconstruct(int(i)) for i in candidates])
+        signs = np.unpackbits(codes, axis=1)[:, :query_vector.shape[1]].astype('float32') * 2 - 1
+        # Dividing by sqrt(d) keeps scores on the cosine scale of the float indexes
+        scores = signs @ query_vector[0] / np.sqrt(query_vector.shape[1])
+
+        order = np.argsort(-scores)[:k]
+        return scores[order][None, :], candidates[order][None, :]
 
     def reset_index(self):
         """Clears the current index and chunks."""
         self.index = None
         self.chunks = []
+        self.min_score = None
         print("Index reset.")
 
     def query(self, query_text: str, k: int = 3) -> List[str]:
         """Retrieves the top-k most relevant chunks for the query."""
         if self.index is None or not self.chunks:
             return []
+
+        # The whole document fits in the prompt, so skip encoding and searching
+        if self.index.ntotal <= SMALL_INDEX_SIZE:
+            return list(self.chunks)
         
         # Ensure model is loaded for encoding the query
         self.load_model()
         
-        query_vector = self.model.encode([query_text])
-        distances, indices = self.index.search(query_vector.astype('float32'), k)
+        # Repeated questions skip the embedding model entirely
+        return self._retrieve(_encode_query(self.model, query_text), k)[0]
+
+    def query_batch(self, queries: List[str], k: int = 3) -> List[List[str]]:
+        """Retrieves the top-k chunks for each query, encoding all queries in one batch."""
+        if self.index is None or not self.chunks:
+            return [[] for _ in queries]
+        if self.index.ntotal <= SMALL_INDEX_SIZE:
+            return [list(self.chunks) for _ in queries]
+
+        self.load_model()
+
+        query_vectors = _as_float32(self.model.encode(queries, batch_size=QUERY_BATCH_SIZE, convert_to_numpy=True,
+                                                      normalize_embeddings=True, precision='float32'))
+        return self._retrieve(query_vectors, k)
+
+    def _retrieve(self, query_vectors: np.ndarray, k: int) -> List[List[str]]:
+        """Searches the index with normalized query vectors and returns the chunks found for each."""
+        if isinstance(self.index, faiss.IndexBinary):
+            hits = [self._search_binary(query_vector[None, :], k) for query_vector in query_vectors]
+        else:
+            if hasattr(self.index, 'hnsw'):
+                self.index.hnsw.efSearch = max(32, 4 * k)
+            distances, indices = self.index.search(query_vectors, k)
+            hits = [(distances[i:i + 1], indices[i:i + 1]) for i in range(len(query_vectors))]
         
+        # Drop weak matches: they add prompt length (and prefill time) without helping the answer.
+        # Hits come best first, and the best one is always kept: on a single-topic document even
+        # the right answer can score below the document's mean pairwise similarity.
+        min_score = self.min_score if self.min_score is not None else float('-inf')
         results = []
-        for idx in indices[0]:
-            if idx != -1 and idx < len(self.chunks):
-                results.append(self.chunks[idx])
+        for distances, indices in hits:
+            found = [(score, idx) for score, idx in zip(distances[0], indices[0])
+                     if idx != -1 and idx < len(self.chunks)]
+            results.append([self.chunks[idx] for rank, (score, idx) in enumerate(found)
+                            if rank == 0 or score >= min_score])
                 
         return results
@@ -0,0 +1,149 @@
+import functools
+import glob
+import json
+import mmap
+import os
+from typing import Iterable, List, Set
+
+import numpy as np
+import onnxruntime_genai as og
+
+def _parse_cpu_list(cpu_list: str) -> Set[int]:
+    """Parses a kernel CPU list such as '0-7,16-23'."""
+    cpus = set()
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+def pin_to_numa_node(node: int = 0):
+    """On multi-socket machines, keeps the calling thread (and the threads it spawns) on one NUMA node."""
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    if len(glob.glob('/sys/devices/system/node/node[0-9]*')) < 2:
+        return
+    try:
+        with open(f'/sys/devices/system/node/node{node}/cpulist') as f:
+            cpus = _parse_cpu_list(f.read()) & os.sched_getaffinity(0)
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+    except OSError:
+        pass
+
+def physical_core_count() -> int:
+    """Counts the physical cores this process may run on, ignoring SMT siblings."""
+    allowed = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else None
+    cores = set()
+    try:
+        with open('/proc/cpuinfo') as f:
+            processor = physical_id = None
+            for line in f:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key == 'processor':
+                    processor = int(value)
+                elif key == 'physical id':
+                    physical_id = value.strip()
+                elif key == 'core id' and (allowed is None or processor in allowed):
+                    cores.add((physical_id, value.strip()))
+    except (OSError, ValueError):
+        pass
+    if cores:
+        return len(cores)
+    return len(allowed) if allowed else (os.cpu_count() or 1)
+
+def transparent_hugepage_mode() -> str:
+    """Returns the active transparent huge page mode ('always', 'madvise', 'never'), or '' if unknown."""
+    try:
+        with open('/sys/kernel/mm/transparent_hugepage/enabled') as f:
+            setting = f.read()
+    except OSError:
+        return ''
+    start, end = setting.find('['), setting.find(']')
+    return setting[start + 1:end] if start != -1 and end > start else ''
+
+def prefetch_weights(model_path: str):
+    """
+    Advises the kernel to start reading the model files into the page cache (MADV_WILLNEED
+    readahead), so og.Model's load doesn't fault them in page by page.
+    """
+    if not hasattr(mmap, 'MADV_WILLNEED'):
+        return
+    for path in glob.glob(os.path.join(model_path, '*.onnx*')):
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    m.madvise(mmap.MADV_WILLNEED)
+        except (OSError, ValueError):
+            pass
+
+def load_llm(model_path: str):
+    """
+    Loads the ONNX model with session options tuned for CPU decoding. Processes that only serve
+    the model should call pin_to_numa_node() from their main thread first.
+    """
+    # Hyperthreads share their core's memory bandwidth, so extra threads only add contention
+    threads = physical_core_count()
+
+    # Decoding re-reads all weights for every token; without huge pages that's a TLB miss every 4 KB.
+    # Huge pages are a system setting (see README), not something this process can request for og's buffers.
+    if transparent_hugepage_mode() == 'never':
+        print("Note: transparent huge pages are disabled; see README for enabling them to speed up decoding.")
+    prefetch_weights(model_path)
+
+    config = og.Config(model_path)
+    if hasattr(config, 'overlay'):
+        try:
+            config.overlay(json.dumps({"model": {"decoder": {"session_options": {
+                "intra_op_num_threads": threads,
+                "graph_optimization_level": "ORT_ENABLE_ALL",
+            }}}}))
+        except Exception as e:
+            print(f"Warning: could not apply session options, using defaults: {e}")
+    return og.Model(config)
+
+class PromptTemplate:
+    """
+    Builds Phi-3 chat prompts as token ids. The fixed template markers are tokenized once at
+    startup, and the system prompt is cached, so only the new text is tokenized per request.
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.user_prefix = tokenizer.encode("<|user|>\n")
+        self.assistant_prefix = tokenizer.encode("<|end|>\n<|assistant|>\n")
+        # Closes an assistant turn that stopped before the model produced its own <|end|>
+        self.end_of_turn = tokenizer.encode("<|end|>\n")
+        self._encode_system = functools.lru_cache(maxsize=8)(tokenizer.encode)
+
+    def encode_turn(self, text: str, system_prompt: str = "") -> np.ndarray:
+        """Returns the tokens of `<|user|>\n{system_prompt}\n{text}<|end|>\n<|assistant|>\n`."""
+        parts = [self.user_prefix]
+        if system_prompt:
+            parts.append(self._encode_system(f"{system_prompt}\n"))
+        parts.extend([self.tokenizer.encode(text), self.assistant_prefix])
+        return np.concatenate(parts)
+
+def generate_steps(generator, n: int) -> List:
+    """
+    Runs up to n decode steps, stopping early if generation finishes, and returns the
+    next-token array (one entry per sequence) of every step. Meant to run in a worker thread
+    so callers hand off once per n tokens instead of once per token.
+    """
+    steps = []
+    while len(steps) < n and not generator.is_done():
+        generator.generate_next_token()
+        steps.append(generator.get_next_tokens())
+    return steps
+
+def decode_tokens(tokenizer_stream, tokens: Iterable) -> str:
+    """Decodes a run of tokens into one string."""
+    # The stream keeps partial multi-byte characters and word-piece spacing between calls,
+    # which a one-shot tokenizer.decode of each run would lose at run boundaries.
+    return "".join(tokenizer_stream.decode(token) for token in tokens)
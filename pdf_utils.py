@@ -0,0 +1,46 @@
+import io
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+import pypdf
+
+# PDFs shorter than this are extracted in-process. A worker costs ~0.1 s to start (interpreter plus
+# pypdf import) while text-heavy pages extract in ~6 ms each, so splitting only pays off well past that.
+PARALLEL_PDF_MIN_PAGES = 64
+
+def _extract_pages(data: bytes, start: int, stop: int) -> str:
+    """Extracts the text of pages [start, stop)."""
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    return "".join(reader.pages[i].extract_text() + "\n" for i in range(start, stop))
+
+def _extract_in_subprocess(data: bytes, start: int, stop: int) -> str:
+    """
+    Extracts pages [start, stop) in a fresh `python pdf_utils.py` process. Unlike a multiprocessing
+    pool, this never forks the caller or re-imports its __main__ (and with it torch and faiss).
+    """
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), str(start), str(stop)],
+                            input=data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"PDF worker failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout.decode('utf-8')
+
+def extract_pdf_text(data: bytes) -> str:
+    """Extracts text from a PDF, splitting the pages across worker processes for long documents."""
+    num_pages = len(pypdf.PdfReader(io.BytesIO(data)).pages)
+    workers = min(os.cpu_count() or 1, num_pages)
+    if num_pages < PARALLEL_PDF_MIN_PAGES or workers < 2:
+        return _extract_pages(data, 0, num_pages)
+
+    # One contiguous page range per worker so each process parses the PDF only once.
+    # The threads only wait on their subprocess, so they don't contend for the GIL.
+    bounds = [num_pages * i // workers for i in range(workers + 1)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return "".join(pool.map(_extract_in_subprocess, repeat(data), bounds[:-1], bounds[1:]))
+
+if __name__ == "__main__":
+    # Worker entry point: PDF bytes on stdin, text of pages [argv[1], argv[2]) on stdout
+    text = _extract_pages(sys.stdin.buffer.read(), int(sys.argv[1]), int(sys.argv[2]))
+    sys.stdout.buffer.write(text.encode('utf-8'))
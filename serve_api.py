@@ -1,39 +1,244 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import onnxruntime_genai as og
+import asyncio
+import json
 import os
+import numpy as np
 import contextlib
+from collections import OrderedDict
+from typing import Optional
+from model_utils import PromptTemplate, decode_tokens, generate_steps, load_llm, pin_to_numa_node
+
+SESSION_MAX_LENGTH = 2048
+# Every session keeps its own KV cache in memory, so only a few conversations stay resident
+MAX_SESSIONS = 4
+# How long the batch worker waits for more requests to join a batch
+BATCH_WINDOW = 0.005
+# Each sequence in a batch gets its own KV cache, so this also caps KV-cache memory
+MAX_BATCH_SIZE = 4
+# Decode steps per threadpool handoff; tokens are decoded and queued as one run
+TOKENS_PER_STEP = 8
 
 # Global variables for model and tokenizer
 model = None
 tokenizer = None
-tokenizer_stream = None
+prompt_template = None
+eos_token_ids = set()
+pad_token_id = 0
+sessions = OrderedDict() # session_id -> ChatSession, least recently used first
+session_lock = None # asyncio.Lock serializing session requests
+request_queue = None # asyncio.Queue of PendingRequest consumed by batch_worker
+background_tasks = set() # Strong references to running session tasks
+
+class ChatSession:
+    """A conversation whose generator, and therefore KV cache, is reused across requests."""
+    def __init__(self):
+        params = og.GeneratorParams(model)
+        params.set_search_options(max_length=SESSION_MAX_LENGTH)
+        self.generator = og.Generator(model, params)
+        self.tokenizer_stream = tokenizer.create_stream()
+        self.token_count = 0
+        # True when the last assistant turn was cut off (max_tokens or disconnect) before EOS
+        self.turn_open = False
+
+def get_session(session_id: str, num_new_tokens: int) -> ChatSession:
+    """Returns the cached session, starting a new one if it is unknown or its context is full."""
+    session = sessions.pop(session_id, None)
+    if session is None or session.token_count + num_new_tokens >= SESSION_MAX_LENGTH:
+        session = ChatSession()
+    sessions[session_id] = session
+    while len(sessions) > MAX_SESSIONS:
+        sessions.popitem(last=False)
+    return session
+
+def load_special_tokens(model_path: str):
+    """Reads the end-of-sequence token ids and the padding token id from the model's genai_config.json."""
+    with open(os.path.join(model_path, "genai_config.json")) as f:
+        config = json.load(f)["model"]
+    eos = config["eos_token_id"]
+    return (set(eos) if isinstance(eos, list) else {eos}), config["pad_token_id"]
+
+def pad_batch(sequences) -> np.ndarray:
+    """Left-pads token sequences to a common length, the layout tokenizer.encode_batch produces."""
+    width = max(len(sequence) for sequence in sequences)
+    batch = np.full((len(sequences), width), pad_token_id, dtype=np.int32)
+    for row, sequence in zip(batch, sequences):
+        row[width - len(sequence):] = sequence
+    return batch
+
+class PendingRequest:
+    """A /chat request in flight. Generated text is pushed to `output`; None marks the end."""
+    def __init__(self, request, input_tokens: np.ndarray):
+        self.request = request
+        self.input_tokens = input_tokens
+        self.output = asyncio.Queue()
+        self.tokenizer_stream = tokenizer.create_stream()
+        self.num_generated = 0
+        self.done = False
+
+    def emit(self, tokens: list):
+        """Queues the decoded text of a run of tokens, finishing once max_tokens is reached."""
+        tokens = tokens[:self.request.max_tokens - self.num_generated]
+        if tokens:
+            self.output.put_nowait(decode_tokens(self.tokenizer_stream, tokens))
+        self.num_generated += len(tokens)
+        if self.num_generated >= self.request.max_tokens:
+            self.finish()
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.output.put_nowait(None)
+
+    def fail(self, error: Exception):
+        if not self.done:
+            self.done = True
+            self.output.put_nowait(error)
+
+    async def tokens(self):
+        """Yields decoded text as it is generated, re-raising any generation error."""
+        while True:
+            item = await self.output.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+async def run_batch(batch):
+    """Generates for several requests at once, one decode step for the whole batch per token."""
+    input_tokens = pad_batch([pending.input_tokens for pending in batch])
+    params = og.GeneratorParams(model)
+    params.set_search_options(batch_size=len(batch),
+                              max_length=input_tokens.shape[1] + max(p.request.max_tokens for p in batch))
+    generator = og.Generator(model, params)
+    await run_in_threadpool(generator.append_tokens, input_tokens)
+
+    while not generator.is_done():
+        steps = await run_in_threadpool(generate_steps, generator, TOKENS_PER_STEP)
+        for i, pending in enumerate(batch):
+            if pending.done:
+                continue
+            tokens = []
+            for step in steps:
+                if int(step[i]) in eos_token_ids:
+                    pending.emit(tokens)
+                    pending.finish()
+                    break
+                tokens.append(step[i])
+            else:
+                pending.emit(tokens)
+        # Finished requests are answered right away; stop once no request still wants tokens
+        if all(pending.done for pending in batch):
+            break
+
+    for pending in batch:
+        pending.finish()
+
+async def batch_worker():
+    """Collects requests arriving within BATCH_WINDOW into one batch and runs it."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await request_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(request_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await run_batch(batch)
+        except Exception as e:
+            for pending in batch:
+                pending.fail(e)
+
+async def run_session(pending: PendingRequest):
+    """Continues a cached conversation. Earlier turns are already in its KV cache, so only the new turn is prefilled."""
+    session_id = pending.request.session_id
+    async with session_lock:
+        try:
+            input_tokens = pending.input_tokens
+            end_of_turn = prompt_template.end_of_turn
+            session = get_session(session_id, len(end_of_turn) + len(input_tokens))
+            if session.turn_open:
+                # Close the previous, unfinished assistant turn so the prompt keeps Phi-3's structure
+                input_tokens = np.concatenate([end_of_turn, input_tokens])
+            pending.tokenizer_stream = session.tokenizer_stream
+            generator = session.generator
+            await run_in_threadpool(generator.append_tokens, input_tokens)
+            session.token_count += len(input_tokens)
+
+            session.turn_open = True
+            while not generator.is_done() and not pending.done:
+                remaining = pending.request.max_tokens - pending.num_generated
+                steps = await run_in_threadpool(generate_steps, generator, min(TOKENS_PER_STEP, remaining))
+                session.token_count += len(steps)
+                if steps and int(steps[-1][0]) in eos_token_ids:
+                    session.turn_open = False
+                pending.emit([step[0] for step in steps])
+            pending.finish()
+        except Exception as e:
+            sessions.pop(session_id, None)
+            pending.fail(e)
+
+async def stream_events(pending: PendingRequest):
+    """Formats generated text as server-sent events, one event per decoded run of up to TOKENS_PER_STEP tokens."""
+    try:
+        async for text in pending.tokens():
+            # JSON-encode so newlines in the text can't break the event framing
+            yield f"data: {json.dumps(text)}\n\n"
+        yield "data: [DONE]\n\n"
+    except Exception as e:
+        yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+    finally:
+        # If the client disconnected early, stop generating tokens for it
+        pending.finish()
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model, tokenizer, tokenizer_stream
+    global model, tokenizer, prompt_template, eos_token_ids, pad_token_id, session_lock, request_queue
     model_path = "./model"
+    worker = None
     if not os.path.exists(model_path) or not os.listdir(model_path):
         print("Error: Model not found in ./model. Please run setup_model.py first.")
         # In a real app we might raise an error, but here we just warn
     else:
         print("Loading model...")
+        # Runs on the main thread before any worker threads exist, so the threadpool and the
+        # model's inference threads all inherit the affinity: cross-socket weight reads are slow
+        pin_to_numa_node()
         try:
-            model = og.Model(model_path)
+            model = load_llm(model_path)
             tokenizer = og.Tokenizer(model)
-            tokenizer_stream = tokenizer.create_stream()
+            prompt_template = PromptTemplate(tokenizer)
+            eos_token_ids, pad_token_id = load_special_tokens(model_path)
+            session_lock = asyncio.Lock()
+            request_queue = asyncio.Queue()
+            worker = asyncio.create_task(batch_worker())
             print("Model loaded successfully.")
         except Exception as e:
             print(f"Failed to load model: {e}")
     yield
     # Cleanup if needed
     print("Shutting down...")
+    if worker is not None:
+        worker.cancel()
 
 app = FastAPI(lifespan=lifespan)
 
 class ChatRequest(BaseModel):
     prompt: str
     max_tokens: int = 500
+    # Requests sharing a session_id continue the same conversation without re-processing earlier turns
+    session_id: Optional[str] = None
+    # Stream tokens as server-sent events instead of returning one JSON response
+    stream: bool = False
 
 class ChatResponse(BaseModel):
     response: str
@@ -41,31 +246,28 @@ class ChatResponse(BaseModel):
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest):
     global model, tokenizer
-    
+
     if model is None or tokenizer is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
 
     try:
-        # Phi-3 prompt structure
-        formatted_prompt = f"<|user|>\n{request.prompt}<|end|>\n<|assistant|>\n"
-        
-        input_tokens = tokenizer.encode(formatted_prompt)
+        # Phi-3 prompt structure, with the template tokens pre-tokenized at startup
+        input_tokens = prompt_template.encode_turn(request.prompt)
 
-        params = og.GeneratorParams(model)
-        params.set_search_options(max_length=request.max_tokens)
-        
-        generator = og.Generator(model, params)
-        generator.append_tokens(input_tokens)
-
-        generated_text = ""
-        
-        while not generator.is_done():
-            generator.generate_next_token()
-            new_token = generator.get_next_tokens()[0]
-            decoded_token = tokenizer_stream.decode(new_token)
-            generated_text += decoded_token
-            
-        return ChatResponse(response=generated_text)
+        pending = PendingRequest(request, input_tokens)
+        if request.session_id is not None:
+            task = asyncio.create_task(run_session(pending))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+        else:
+            # Session-less requests are batched with whatever else arrives at the same time
+            request_queue.put_nowait(pending)
+
+        if request.stream:
+            return StreamingResponse(stream_events(pending), media_type="text/event-stream")
+
+        parts = [text async for text in pending.tokens()]
+        return ChatResponse(response="".join(parts))
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
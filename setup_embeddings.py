@@ -1,13 +1,38 @@
 import os
-from sentence_transformers import SentenceTransformer
+import platform
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+from optimum.onnxruntime import AutoQuantizationConfig
+from embedding_utils import cpu_flags
+
+def _quantization_target() -> str:
+    """Picks the ONNX Runtime dynamic quantization config that matches this CPU."""
+    if platform.machine().lower() in ('arm64', 'aarch64'):
+        return 'arm64'
+    flags = cpu_flags()
+    if 'avx512_vnni' in flags:
+        return 'avx512_vnni'
+    if 'avx512f' in flags:
+        return 'avx512'
+    return 'avx2'
 
 def setup_embeddings():
     model_name = 'all-MiniLM-L6-v2'
+    output_dir = './embed_model'
     print(f"Downloading embedding model: {model_name}...")
     # This will download the model to the local cache (usually ~/.cache/huggingface/hub)
-    # or we can specify a path if we want it local to the project, but cache is standard.
-    model = SentenceTransformer(model_name)
+    # and export it to ONNX so it can run on the ONNX Runtime backend.
+    model = SentenceTransformer(model_name, backend='onnx')
+    model.save(output_dir)
     print("Embedding model downloaded successfully.")
 
+    # Dynamic INT8 quantization: weights are quantized ahead of time, activations at runtime,
+    # so no calibration data is needed. AVX512-VNNI CPUs get int8 dot-product kernels.
+    target = _quantization_target()
+    print(f"Quantizing embedding model to INT8 ({target})...")
+    quantization_config = getattr(AutoQuantizationConfig, target)(is_static=False, per_channel=False)
+    export_dynamic_quantized_onnx_model(model, quantization_config, output_dir,
+                                        file_suffix=f"qint8_{target}")
+    print(f"Quantized embedding model saved to {os.path.join(output_dir, 'onnx')}.")
+
 if __name__ == "__main__":
     setup_embeddings()
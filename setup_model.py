@@ -1,6 +1,58 @@
 import os
+import importlib.util
+import json
+import mmap
+import subprocess
+import sys
+
+# hf_transfer downloads each file over parallel connections. huggingface_hub reads this flag
+# at import time, and fails downloads if it is set without hf_transfer installed.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 from huggingface_hub import snapshot_download
 
+# Fused attention kernels that tile Q/K/V instead of materializing the full attention matrix
+FUSED_ATTENTION_OPS = (b"GroupQueryAttention", b"MultiHeadAttention")
+
+def optimize_attention(model_dir: str):
+    """
+    Makes sure the decoder runs attention as a fused kernel. The onnxruntime-genai builds of
+    Phi-3 already use GroupQueryAttention; other exports are rewritten with ONNX Runtime's
+    transformer optimizer and genai_config.json is pointed at the optimized file.
+    """
+    config_path = os.path.join(model_dir, "genai_config.json")
+    with open(config_path) as f:
+        config = json.load(f)
+    model_file = config["model"]["decoder"]["filename"]
+    model_path = os.path.join(model_dir, model_file)
+
+    # Op types are stored as plain strings in the graph protobuf, so no onnx dependency is needed
+    with open(model_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as graph:
+        if any(graph.find(op) != -1 for op in FUSED_ATTENTION_OPS):
+            print("Attention is already fused; no graph optimization needed.")
+            return
+
+    if importlib.util.find_spec("onnxruntime") is None:
+        print("Attention is not fused and onnxruntime is not installed; skipping graph optimization.")
+        return
+
+    optimized_file = model_file.replace(".onnx", "_opt.onnx")
+    print(f"Fusing attention into {optimized_file}...")
+    try:
+        subprocess.run([sys.executable, "-m", "onnxruntime.transformers.optimizer",
+                        "--input", model_path, "--output", os.path.join(model_dir, optimized_file),
+                        "--model_type", "phi", "--opt_level", "99", "--use_multi_head_attention",
+                        "--use_external_data_format"], check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"Graph optimization failed, keeping the original model: {e}")
+        return
+
+    config["model"]["decoder"]["filename"] = optimized_file
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=4)
+    print("Model now uses the optimized graph.")
+
 def download_model():
     """
     Downloads the specific CPU-optimized version of Phi-3.5-mini-instruct-onnx.
@@ -17,7 +69,7 @@ def download_model():
             repo_id=model_id,
             allow_patterns=[f"{subfolder}/*"],
             local_dir=local_dir,
-            local_dir_use_symlinks=False
+            max_workers=8
         )
         
         # The snapshot_download with allow_patterns might create the directory structure
@@ -65,6 +117,8 @@ def download_model():
                 
             print("Files moved to ./model root.")
 
+        optimize_attention(local_dir)
+
     except Exception as e:
         print(f"Error downloading model: {e}")
 
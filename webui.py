@@ -1,5 +1,6 @@
 import asyncio
 import io
+import json
 import os
 import sys
 import threading
@@ -11,6 +12,10 @@ import onnxruntime_genai as og
 import pypdf
 from nicegui import app, ui, run
 from embedding_utils import RAGHandler
+from model_utils import PromptTemplate, decode_tokens, generate_steps, load_llm
+
+# Tokens generated per executor handoff; one handoff per token costs about as much as a decode step
+TOKENS_PER_STEP = 8
 
 # --- LLM Interface ---
 
@@ -20,6 +25,7 @@ class LLMInterface:
         self.model = None
         self.tokenizer = None
         self.tokenizer_stream = None
+        self.prompt_template = None
         self.is_loaded = False
 
     def load_model(self):
@@ -29,23 +35,24 @@ class LLMInterface:
         
         print(f"Loading model from {self.model_path}...")
         try:
-            self.model = og.Model(self.model_path)
+            self.model = load_llm(self.model_path)
             self.tokenizer = og.Tokenizer(self.model)
             self.tokenizer_stream = self.tokenizer.create_stream()
+            self.prompt_template = PromptTemplate(self.tokenizer)
             self.is_loaded = True
             print("Model loaded successfully.")
         except Exception as e:
             print(f"Failed to load model: {e}")
             raise e
 
-    async def generate(self, prompt: str, max_tokens: int = 500) -> Generator[str, None, None]:
-        """Generates text from the model, yielding tokens as they are generated."""
+    async def generate(self, text: str, system_prompt: str = "", max_tokens: int = 500) -> Generator[str, None, None]:
+        """Generates a reply to text in the Phi-3 chat format, yielding tokens as they are generated."""
         if not self.is_loaded:
             raise RuntimeError("Model not loaded")
 
         # Run the setup in an executor to avoid blocking
         def _prepare_generator():
-            input_tokens = self.tokenizer.encode(prompt)
+            input_tokens = self.prompt_template.encode_turn(text, system_prompt)
             input_len = len(input_tokens)
             
             # Calculate total max length (input + new tokens)
@@ -68,12 +75,10 @@ class LLMInterface:
         generator = await run.io_bound(_prepare_generator)
 
         while not generator.is_done():
-            # Run the next token generation in an executor
-            await run.io_bound(generator.generate_next_token)
-            
-            new_token = generator.get_next_tokens()[0]
-            decoded_token = self.tokenizer_stream.decode(new_token)
-            yield decoded_token
+            # Run a few token generations per executor call to cut per-token thread handoffs,
+            # and yield them as one string so the UI also updates once per run
+            steps = await run.io_bound(generate_steps, generator, TOKENS_PER_STEP)
+            yield decode_tokens(self.tokenizer_stream, (step[0] for step in steps))
 
 # --- Global State ---
 
@@ -256,7 +261,8 @@ async def main_page():
         elif is_conversational:
              print(f"Skipping RAG for conversational input: {text}")
             
-        full_prompt = f"<|user|>\n{system_prompt.value}\n{context_str}{text}<|end|>\n<|assistant|>\n"
+        # The Phi-3 template and system prompt tokens are cached; only context and question are tokenized
+        user_text = f"{context_str}{text}"
         
         # Add assistant message placeholder
         with chat_container:
@@ -269,22 +275,29 @@ async def main_page():
             with message_row:
                 spinner
         
-        response_text = ""
+        # Each token is converted to HTML once and only that new HTML is sent to the browser
+        response_parts = []
         
         try:
-            async for token in llm.generate(full_prompt, max_tokens=int(max_tokens.value)):
+            async for token in llm.generate(user_text, system_prompt.value, max_tokens=int(max_tokens.value)):
                 if spinner.visible:
                     spinner.visible = False
                     # Re-render message row to show text instead of spinner
                     message_row.clear()
                     with message_row:
-                        message_content = ui.html(response_text)
+                        message_content = ui.html('')
                 
-                response_text += token
-                message_content.content = response_text.replace('\n', '<br>')
+                token_html = token.replace('\n', '<br>')
+                response_parts.append(token_html)
+                # Append in the DOM instead of replacing the content, which re-sends the whole reply every update
+                ui.run_javascript(f"document.getElementById('c{message_content.id}')"
+                                  f".insertAdjacentHTML('beforeend', {json.dumps(token_html)})")
                 
         except Exception as e:
             ui.notify(f"Error generating response: {e}", type='negative')
+        finally:
+            # Sync the element's server-side content once, so it survives a page re-render
+            message_content.content = ''.join(response_parts)
         
         is_generating = False
         send_button.enable()